@@ -1,54 +1,79 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 import numpy as np
-import os
+import math
 import warnings 
 import random
-from sklearn.metrics import roc_auc_score, confusion_matrix, classification_report
+from sklearn.metrics import roc_auc_score, classification_report
 
 warnings.filterwarnings("ignore")
 DEFAULT_RANDOM_SEED = 42
 
 
+# PYTHONHASHSEED is read only at interpreter startup, so it has to be
+# exported before running python if hash determinism matters
 def SeedBasic(seed = DEFAULT_RANDOM_SEED):
     random.seed(seed)
-    os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
 
 
-def SeedTorch(seed = DEFAULT_RANDOM_SEED):
+def SeedTorch(seed = DEFAULT_RANDOM_SEED, deterministic = False):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark     = False
+    # all ECG batches share the (B, 12, signal_length) shape, so benchmark mode
+    # picks the fastest conv algorithm once and reuses it for the whole run
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark     = not deterministic
 
+    torch.use_deterministic_algorithms(deterministic, warn_only=True)
 
-def SeedEverything(seed = DEFAULT_RANDOM_SEED):
+
+def SeedEverything(seed = DEFAULT_RANDOM_SEED, deterministic = False):
     SeedBasic(seed)
-    SeedTorch(seed)
+    SeedTorch(seed, deterministic)
 
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print(f"Training will take on {device}")
 
+use_amp = device == 'cuda'
+
 SeedEverything()
 
 
+class Conv1dNHWC(nn.Conv2d):
+    # Conv1d over (B, C, 1, L) activations as a (1, k) Conv2d, weights and activations stay
+    # channels_last through the whole network so cuDNN can use the NHWC Tensor Core kernels
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, groups=1, bias=True):
+        super().__init__(in_channels, out_channels, kernel_size=(1, kernel_size),
+                         stride=(1, stride), padding=(0, padding), groups=groups, bias=bias)
+
+        self.to(memory_format=torch.channels_last)
+
+
 class Bottleneck(nn.Module):
     expansion = 4
     
-    def __init__(self, inplanes, planes, stride=1, downsample = None):
+    def __init__(self, inplanes, planes, stride=1, downsample = None, use_depthwise=False):
         super().__init__()
 
-        self.conv_1 = nn.Conv1d(inplanes, planes, kernel_size=1, stride=1, padding=0)
-        self.batch_norm_1 = nn.BatchNorm1d(planes)
-        self.conv_2 = nn.Conv1d(planes, planes, kernel_size=3, stride=stride, padding=1)
-        self.batch_norm_2 = nn.BatchNorm1d(planes)
-        self.conv_3 = nn.Conv1d(planes, planes * self.expansion, kernel_size=1, stride=1, padding=0)
-        self.batch_norm_3 = nn.BatchNorm1d(planes * self.expansion)
+        self.conv_1 = Conv1dNHWC(inplanes, planes, kernel_size=1, stride=1, padding=0, bias=False)
+        self.batch_norm_1 = nn.BatchNorm2d(planes)
+        if use_depthwise:
+            self.conv_2 = nn.Sequential(
+                Conv1dNHWC(planes, planes, kernel_size=3, stride=stride, padding=1, groups=planes, bias=False),
+                Conv1dNHWC(planes, planes, kernel_size=1, stride=1, padding=0, bias=False)
+            )
+        else:
+            self.conv_2 = Conv1dNHWC(planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.batch_norm_2 = nn.BatchNorm2d(planes)
+        self.conv_3 = Conv1dNHWC(planes, planes * self.expansion, kernel_size=1, stride=1, padding=0, bias=False)
+        self.batch_norm_3 = nn.BatchNorm2d(planes * self.expansion)
 
-        self.relu = nn.ReLU()
+        self.relu = nn.ReLU(inplace=True)
         self.downsample = downsample
         self.stride = stride
 
@@ -78,42 +103,66 @@ class Bottleneck(nn.Module):
 
 
 class ResNet(nn.Module):
-    def __init__(self, block, layers, num_classes=1000):
+    def __init__(self, block, layers, num_classes=1000, use_checkpoint=False, use_depthwise=False, depthwise_stem=False):
         super().__init__()
 
         self.inplanes = 64
-
-        self.conv_1 = nn.Conv1d(12, 64, kernel_size=15, stride=2, padding=7, bias=False)
-        self.batch_norm_1 = nn.BatchNorm1d(64)
+        self.use_checkpoint = use_checkpoint
+        self.use_depthwise  = use_depthwise
+
+        if depthwise_stem:
+            # per-lead 15-tap filter followed by 1x1 lead mixing
+            self.conv_1 = nn.Sequential(
+                Conv1dNHWC(12, 12, kernel_size=15, stride=2, padding=7, groups=12, bias=False),
+                Conv1dNHWC(12, 64, kernel_size=1, bias=False)
+            )
+        else:
+            self.conv_1 = Conv1dNHWC(12, 64, kernel_size=15, stride=2, padding=7, bias=False)
+        self.batch_norm_1 = nn.BatchNorm2d(64)
         self.relu = nn.ReLU()
-        self.maxpool_1 = nn.MaxPool1d(kernel_size=3, stride=2, padding=1)
+        self.maxpool_1 = nn.MaxPool2d(kernel_size=(1, 3), stride=(1, 2), padding=(0, 1))
         
         self.layer_1 = self._make_layer(block, 64, layers[0])
         self.layer_2 = self._make_layer(block, 128, layers[1], stride=2)
         self.layer_3 = self._make_layer(block, 256, layers[2], stride=2)
         self.layer_4 = self._make_layer(block, 512, layers[3], stride=2)
 
-        self.avg_pool = nn.AdaptiveAvgPool1d(1)
+        self.avg_pool = nn.AdaptiveAvgPool2d(1)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
 
         for m in self.modules():
-            if isinstance(m, nn.Conv1d):
+            if isinstance(m, nn.Conv2d):
                 nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
-            elif isinstance(m, nn.BatchNorm1d):
+            elif isinstance(m, nn.BatchNorm2d):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        if use_checkpoint:
+            # checkpointed blocks run BatchNorm2d twice per step on the same batch (forward and
+            # recompute), two updates with m' = 1 - sqrt(1 - m) equal one running stats update with m
+            for m in [*self.layer_3.modules(), *self.layer_4.modules()]:
+                if isinstance(m, nn.BatchNorm2d):
+                    m.momentum = 1 - math.sqrt(1 - m.momentum)
+
 
     def forward(self, x):
-        out = self.conv_1(x)
+        # (B, 12, L) -> (B, 12, 1, L) channels_last, the height dim is only squeezed before fc
+        out = x.unsqueeze(2).contiguous(memory_format=torch.channels_last)
+
+        out = self.conv_1(out)
         out = self.batch_norm_1(out)
         out = self.relu(out)
         out = self.maxpool_1(out)
 
         out = self.layer_1(out)
         out = self.layer_2(out)
-        out = self.layer_3(out)
-        out = self.layer_4(out)
+        # every block of the deepest layers is recomputed in backward, only block inputs are kept
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            for block in [*self.layer_3, *self.layer_4]:
+                out = checkpoint(block, out, use_reentrant=False)
+        else:
+            out = self.layer_3(out)
+            out = self.layer_4(out)
 
         out = self.avg_pool(out)
         out = torch.flatten(out, 1)
@@ -122,80 +171,117 @@ class ResNet(nn.Module):
         return out
 
 
+    def fuse_bn(self):
+        # folds every BatchNorm2d into the preceding convolution, the model can only be used for inference afterwards
+        self.eval()
+
+        for module in list(self.modules()):
+            children = list(module.named_children())
+            for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+                if not isinstance(bn, nn.BatchNorm2d):
+                    continue
+
+                # depthwise separable conv: BN is folded into the pointwise part
+                parent = module
+                if isinstance(conv, nn.Sequential):
+                    parent, conv_name, conv = conv, str(len(conv) - 1), conv[-1]
+
+                if isinstance(conv, Conv1dNHWC):
+                    setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+                    setattr(module, bn_name, nn.Identity())
+
+        return self
+
+
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
             downsample = nn.Sequential(
-                nn.Conv1d(self.inplanes, planes * block.expansion, kernel_size=1, stride=stride, bias=False),
-                nn.BatchNorm1d(planes * block.expansion)
+                Conv1dNHWC(self.inplanes, planes * block.expansion, kernel_size=1, stride=stride, bias=False),
+                nn.BatchNorm2d(planes * block.expansion)
             )
 
         layers = []
-        layers.append(block(self.inplanes, planes, stride, downsample))
+        layers.append(block(self.inplanes, planes, stride, downsample, use_depthwise=self.use_depthwise))
         self.inplanes = planes * block.expansion
         for _ in range(1, blocks):
-            layers.append(block(self.inplanes, planes))
+            layers.append(block(self.inplanes, planes, use_depthwise=self.use_depthwise))
 
         return nn.Sequential(*layers)
 
 
+# sigmoid(x) > t is equivalent to x > logit(t), so logits are thresholded directly,
+# t = 0 and t = 1 map to -inf and +inf
+def get_logit_treshold(treshold_preds):
+    if treshold_preds <= 0:
+        return -math.inf
+    if treshold_preds >= 1:
+        return math.inf
+
+    return math.log(treshold_preds / (1 - treshold_preds))
+
+
+# criterion must be nn.BCEWithLogitsLoss: the network outputs raw logits and
+# sigmoid is applied only once to the collected validation/test logits
 def train(net, train_loader, val_loader, 
-          n_epoch, optimizer, criterion, treshold_preds):
+          n_epoch, optimizer, criterion, treshold_preds, num_classes):
     loss_train_history = []
     loss_val_history   = []
 
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+
+    logit_treshold = get_logit_treshold(treshold_preds)
+
     for epoch in range(n_epoch):
         print('Epoch {}/{}:'.format(epoch + 1, n_epoch), flush = True)
 
-        train_loss = val_loss = 0.0
-        train_labels, train_preds, train_prob, val_labels, val_preds, val_prob = [], [], [], [], [], []
+        train_loss = torch.zeros((), device=device)
+        val_loss   = torch.zeros((), device=device)
+
+        # validation metrics are accumulated on device and copied to host once per epoch
+        val_logits   = torch.empty((len(val_loader.dataset), num_classes), device=device)
+        val_labels   = torch.empty((len(val_loader.dataset), num_classes), device=device)
 
         net.train()
 
         for (batch_idx, train_batch) in enumerate(train_loader):
-            samples, labels = train_batch['ecg_signals'].to(device), train_batch['labels'].to(device)
-            optimizer.zero_grad()
+            samples, labels = train_batch['ecg_signals'].to(device, non_blocking=True), train_batch['labels'].to(device, non_blocking=True)
+            optimizer.zero_grad(set_to_none=True)
 
-            preds = net(samples)
-            loss = criterion(preds, labels)
-
-            loss.backward()
-            optimizer.step()
+            with torch.autocast('cuda', dtype=torch.float16, enabled=use_amp):
+                preds = net(samples)
+                loss = criterion(preds, labels)
 
-            train_loss += loss.item()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            with torch.no_grad():
-                preds = torch.sigmoid(preds)
-                bin_preds = (preds > treshold_preds).float()
-                
-                train_prob.append(preds.cpu().numpy())
-                train_labels.append(labels.cpu().numpy())
-                train_preds.append(bin_preds.cpu().numpy())
+            train_loss += loss.detach()
         
-        train_loss /= len(train_loader)
+        train_loss = (train_loss / len(train_loader)).item()
         loss_train_history.append(train_loss)
 
         net.eval()
 
-        with torch.no_grad():
+        with torch.inference_mode():
+            offset = 0
             for val_batch in val_loader:
-                samples, labels = val_batch['ecg_signals'].to(device), val_batch['labels'].to(device)
-                preds = net(samples)
-                val_loss += criterion(preds, labels).item()
-
-                preds = torch.sigmoid(preds)
+                samples, labels = val_batch['ecg_signals'].to(device, non_blocking=True), val_batch['labels'].to(device, non_blocking=True)
+                with torch.autocast('cuda', dtype=torch.float16, enabled=use_amp):
+                    preds = net(samples)
+                    val_loss += criterion(preds, labels).detach()
 
-                bin_preds = (preds > treshold_preds).float()
+                val_logits[offset:offset + len(labels)] = preds
+                val_labels[offset:offset + len(labels)] = labels
+                offset += len(labels)
 
-                val_prob.append(preds.cpu().numpy())
-                val_labels.append(labels.cpu().numpy())
-                val_preds.append(bin_preds.cpu().numpy())
+        val_preds_np, val_prob_np, val_labels_np = (val_logits > logit_treshold).cpu().numpy(), torch.sigmoid(val_logits).cpu().numpy(), val_labels.cpu().numpy()
 
-        val_loss /= len(val_loader)
+        val_loss = (val_loss / len(val_loader)).item()
         loss_val_history.append(val_loss)
 
         print('Validation metrics:')
-        metric_func(np.concatenate(val_labels), np.concatenate(val_preds), np.concatenate(val_prob))
+        metric_func(val_labels_np, val_preds_np, val_prob_np)
 
         print(f'train Loss: {train_loss:.4f}\n'
               f'val Loss: {val_loss:.4f}')
@@ -203,64 +289,59 @@ def train(net, train_loader, val_loader,
     return net, loss_train_history, loss_val_history
 
 
-def test(net, test_loader, criterion, treshold_preds):
+def test(net, test_loader, criterion, treshold_preds, num_classes):
     net.eval()
 
-    test_loss = 0.0
-    test_preds, test_labels, test_prob = [], [], []
+    test_loss = torch.zeros((), device=device)
+    logit_treshold = get_logit_treshold(treshold_preds)
 
-    with torch.no_grad():
-        for (batch_idx, test_batch) in enumerate(test_loader): 
-            samples, labels = test_batch['ecg_signals'].to(device), test_batch['labels'].to(device)
-            preds = net(samples)
+    test_logits = torch.empty((len(test_loader.dataset), num_classes), device=device)
+    test_labels = torch.empty((len(test_loader.dataset), num_classes), device=device)
 
-            test_loss += criterion(preds, labels).item()
+    with torch.inference_mode():
+        offset = 0
+        for (batch_idx, test_batch) in enumerate(test_loader): 
+            samples, labels = test_batch['ecg_signals'].to(device, non_blocking=True), test_batch['labels'].to(device, non_blocking=True)
+            with torch.autocast('cuda', dtype=torch.float16, enabled=use_amp):
+                preds = net(samples)
+                test_loss += criterion(preds, labels).detach()
 
-            preds = torch.sigmoid(preds)
+            test_logits[offset:offset + len(labels)] = preds
+            test_labels[offset:offset + len(labels)] = labels
+            offset += len(labels)
 
-            bin_preds = (preds > treshold_preds).float()
-            test_prob.append(preds.cpu().numpy())
-            test_labels.append(labels.cpu().numpy())
-            test_preds.append(bin_preds.cpu().numpy())
+    test_preds_np, test_prob_np, test_labels_np = (test_logits > logit_treshold).cpu().numpy(), torch.sigmoid(test_logits).cpu().numpy(), test_labels.cpu().numpy()
 
-    test_loss /= len(test_loader)
+    test_loss = (test_loss / len(test_loader)).item()
 
     print('Test metrics:')
-    metric_func(np.concatenate(test_labels), np.concatenate(test_preds), np.concatenate(test_prob))
+    metric_func(test_labels_np, test_preds_np, test_prob_np, full_report=True)
 
     print(f'test Loss: {test_loss:.4f}')
 
     return test_loss
 
 
-def metric_func(bin_labels, bin_preds, preds):    
-    TP, FP, TN, FN = [], [], [], []
-    sensitivity, specificity, precision = [], [], []
-    my_f1   = []
-    roc_auc = []
+def metric_func(bin_labels, bin_preds, preds, full_report=False):    
+    labels_mask, preds_mask = bin_labels.astype(bool), bin_preds.astype(bool)
 
-    for i in range(0, bin_labels.shape[1]):
-        conf_matrix = confusion_matrix(bin_labels[:, i], bin_preds[:, i], labels=[0, 1])
-        TP_i, FP_i, TN_i, FN_i = conf_matrix[1][1], conf_matrix[0][1], conf_matrix[0][0], conf_matrix[1][0]
+    TP = ( labels_mask &  preds_mask).sum(axis=0)
+    FP = (~labels_mask &  preds_mask).sum(axis=0)
+    TN = (~labels_mask & ~preds_mask).sum(axis=0)
+    FN = ( labels_mask & ~preds_mask).sum(axis=0)
 
+    for TP_i, FP_i, TN_i, FN_i in zip(TP, FP, TN, FN):
         print('\t\tTP\tFP\tTN\tFN')
         print(f'\t\t{TP_i}\t{FP_i}\t{TN_i}\t{FN_i}')
-        
-        sensitivity_i = TP_i / (TP_i + FN_i)
-        specificity_i = TN_i / (TN_i + FP_i)
-        precision_i   = TP_i / (TP_i + FP_i)
 
-        TP.append(TP_i)
-        FP.append(FP_i)
-        TN.append(TN_i)
-        FN.append(FN_i)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sensitivity = TP / (TP + FN)
+        specificity = TN / (TN + FP)
+        precision   = TP / (TP + FP)
 
-        sensitivity.append(sensitivity_i)
-        specificity.append(specificity_i)
-        precision.append(precision_i)
+        my_f1 = 2 * sensitivity * precision / (sensitivity + precision)
 
-        my_f1.append(2 * sensitivity_i * precision_i / (sensitivity_i + precision_i))
-        roc_auc.append(roc_auc_score(bin_labels[:, i], preds[:, i]))
+    roc_auc = roc_auc_score(bin_labels, preds, average=None)
 
     # micro averaging
 
@@ -300,5 +381,21 @@ def metric_func(bin_labels, bin_preds, preds):
 
     print(f'ROC AUC: {np.mean(roc_auc)}')
 
-    print(f'Classification report:\n{classification_report(bin_labels, bin_preds)}')
+    # the sklearn report is only built for the final test, per-epoch validation reuses the counts above
+    if full_report:
+        print(f'Classification report:\n{classification_report(bin_labels, bin_preds)}')
+    else:
+        support = TP + FN
+
+        # undefined scores count as 0 in the average, as in classification_report
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weighted_precision = (np.nan_to_num(precision)   * support).sum() / support.sum()
+            weighted_recall    = (np.nan_to_num(sensitivity) * support).sum() / support.sum()
+            weighted_f1        = (np.nan_to_num(my_f1)       * support).sum() / support.sum()
+
+        print('Per-class summary:')
+        print(f'\t{"class":>8}{"precision":>12}{"recall":>12}{"f1-score":>12}{"support":>12}')
+        for i in range(len(TP)):
+            print(f'\t{i:>8}{precision[i]:>12.4f}{sensitivity[i]:>12.4f}{my_f1[i]:>12.4f}{support[i]:>12}')
+        print(f'\t{"weighted":>8}{weighted_precision:>12.4f}{weighted_recall:>12.4f}{weighted_f1:>12.4f}{support.sum():>12}')
 
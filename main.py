@@ -38,6 +38,9 @@ train_dataset, val_dataset, test_dataset = ecg_dataset.get_dataset()
 pos_weight = ecg_dataset.get_pos_weight()
 ecg_dataset.close_dataset()
 
+# trades recompute for activation memory, only worth it together with a batch that does not fit otherwise
+use_checkpoint = False
+
 batch_size    = 32
 learning_rate = 0.0001
 n_epoch       = 10
@@ -47,15 +50,29 @@ treshold_preds = 0.5
 
 criterion = nn.BCEWithLogitsLoss(pos_weight=pos_weight)
 
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size)
-val_loader   = torch.utils.data.DataLoader(val_dataset,   batch_size=batch_size)
-test_loader  = torch.utils.data.DataLoader(test_dataset,  batch_size=batch_size)
+loader_params = {
+    'batch_size': batch_size,
+    'pin_memory': device == 'cuda',
+    'num_workers': 4,
+    'persistent_workers': True,
+    'prefetch_factor': 4
+}
+
+train_loader = torch.utils.data.DataLoader(train_dataset, **loader_params)
+val_loader   = torch.utils.data.DataLoader(val_dataset,   **loader_params)
+test_loader  = torch.utils.data.DataLoader(test_dataset,  **loader_params)
 
-net = ResNet(Bottleneck, [2, 2, 2, 2], num_classes=num_classes).to(device)
+net = ResNet(Bottleneck, [2, 2, 2, 2], num_classes=num_classes, use_checkpoint=use_checkpoint).to(device)
+if device == 'cuda':
+    net = torch.compile(net, mode="reduce-overhead", fullgraph=False)
 optimizer = torch.optim.Adam(net.parameters(), lr=learning_rate, weight_decay=1e-4)
 
 net, loss_train_history, loss_val_history = train(net, train_loader, val_loader, 
-                                                  n_epoch, optimizer, criterion, treshold_preds)
-test_metrics = test(net, test_loader, criterion, treshold_preds)
+                                                  n_epoch, optimizer, criterion, treshold_preds, num_classes)
+
+# fusing swaps submodules, so it is done on the unwrapped module instead of the compiled graph
+net = getattr(net, '_orig_mod', net).fuse_bn()
+
+test_metrics = test(net, test_loader, criterion, treshold_preds, num_classes)
 
 print(f"Test metrics: {test_metrics}")
\ No newline at end of file